@@ -1,14 +1,28 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-import PyPDF2
-import io
-import json
+from fastapi.responses import ORJSONResponse
+import fitz  # PyMuPDF
 import aiohttp
+import hashlib
 import logging
+import math
+import multiprocessing
+import orjson
 import traceback
 import asyncio
 import os
+import shutil
+import tempfile
+import threading
+import tiktoken
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from pydantic import BaseModel, ConfigDict, ValidationError
+import redis.asyncio as redis
 
 # Load environment variables securely from the .env file, following the best practice of keeping secrets out of the codebase
 load_dotenv()
@@ -17,8 +31,35 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)  # Logger setup with appropriate naming for contextual logs across different modules
 
+# Create the PDF extraction pool. Workers are started from a clean forkserver process rather than forked from this one, so
+# they never inherit locks held by the event loop, aiohttp, or to_thread worker threads at fork time
+def _create_pdf_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=int(os.getenv("PDF_WORKERS", os.cpu_count() or 1)),  # Worker count is tunable per deployment
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+# Application lifespan: open one long-lived HTTP session at startup so connections to the model API are reused across uploads,
+# a process pool so concurrent uploads parse PDFs in parallel across CPU cores without contending for the GIL,
+# an optional Redis client backing the shared second-level model response cache, and the tokenizer used for chunking
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    http_connector = aiohttp.TCPConnector(limit=64, keepalive_timeout=75, ttl_dns_cache=300)  # Pooled keep-alive sockets with cached DNS lookups
+    app.state.http = aiohttp.ClientSession(connector=http_connector)
+    app.state.pdf_pool = _create_pdf_pool()
+    redis_url = os.getenv("REDIS_URL")  # Redis is optional; without it only the in-process cache is used
+    app.state.cache = redis.from_url(redis_url) if redis_url else None
+    await asyncio.to_thread(_get_token_encoder)  # The first load may download the BPE file; keep that blocking I/O off the event loop
+    try:
+        yield
+    finally:
+        await app.state.http.close()  # Release pooled connections cleanly on shutdown
+        app.state.pdf_pool.shutdown(wait=True)  # Let in-flight extractions finish before the workers exit
+        if app.state.cache is not None:
+            await app.state.cache.aclose()  # Close the Redis connection pool
+
 # Instantiate the FastAPI application with modular middleware and routing for scalable and maintainable architecture
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)  # Serialize responses with orjson
 
 # CORS configuration: Securely allow cross-origin requests from specified domains, vital for frontend-backend integration in distributed environments
 app.add_middleware(
@@ -32,49 +73,238 @@ app.add_middleware(
 # API configuration: External API endpoint and keys are managed via environment variables for security and flexibility
 MODEL_API_URL = "https://api.ai71.ai/v1/chat/completions"
 MODEL_API_KEY = os.getenv('FALCON_API_KEY')  # Critical to ensure API keys are rotated regularly and stored securely
+MODEL_NAME = "tiiuae/falcon-180B-chat"  # Model used for processing
+SYSTEM_PROMPT = "You are a medical expert analyzing health reports."  # Context-setting for the model
+
+# Analysis instructions and output schema shared by every chunk. They are sent as part of the leading system message so
+# every request starts with an identical prefix that the provider's prompt prefix cache can reuse across chunks and uploads
+ANALYSIS_INSTRUCTIONS = """
+    Analyze the section of a medical report provided by the user and extract key information.
+    Return the results in a JSON format with the following structure:
+    {
+        "summary": "Brief summary of this report section",
+        "abnormal_results": [
+            {"test_name": "Test Name", "value": "Abnormal Value", "reference_range": "Normal Range", "interpretation": "Brief interpretation"}
+        ],
+        "charts": [
+            {
+                "chart_type": "bar",
+                "title": "Chart Title",
+                "data": [
+                    {"label": "Category1", "value1": Number1, "value2": Number2, ...},
+                    {"label": "Category2", "value1": Number1, "value2": Number2, ...},
+                    ...
+                ]
+            },
+            {
+                "chart_type": "area",
+                "title": "Chart Title",
+                "x_axis_key": "month",
+                "data_keys": ["value1", "value2", ...],
+                "data": [
+                    {"month": "January", "value1": Number1, "value2": Number2, ...},
+                    {"month": "February", "value1": Number1, "value2": Number2, ...},
+                    ...
+                ],
+                "trend_percentage": 5.2,
+                "date_range": "January - June 2024"
+            }
+        ],
+        "recommendations": ["Recommendation 1", "Recommendation 2", ...]
+    }
+    """
+ANALYSIS_SYSTEM_MESSAGE = SYSTEM_PROMPT + "\n" + ANALYSIS_INSTRUCTIONS
+
+# Prepare HTTP request with secure authorization headers, ensuring API keys are not exposed
+MODEL_REQUEST_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {MODEL_API_KEY}",
+}
+
+# Pre-serialize the request payload around a placeholder for the per-chunk text, so the model name, system prompt, and
+# multi-kilobyte prompt scaffold are JSON-encoded once at import time instead of on every request
+_CHUNK_PLACEHOLDER = "__MEDICAL_REPORT_SECTION__"
+_PAYLOAD_HEAD, _PAYLOAD_TAIL = orjson.dumps({
+    "model": MODEL_NAME,
+    "messages": [
+        {"role": "system", "content": ANALYSIS_SYSTEM_MESSAGE},  # Stable prefix first; only the user message varies
+        {"role": "user", "content": "Medical Report Section " + _CHUNK_PLACEHOLDER},
+    ],
+    "stream": True,  # Stream tokens back as server-sent events instead of buffering the whole completion
+}).split(_CHUNK_PLACEHOLDER.encode())
+
+# Splice the JSON-escaped section text into the prebuilt payload, yielding the same bytes as encoding the full request
+def _build_request_body(section_text: str) -> bytes:
+    return _PAYLOAD_HEAD + orjson.dumps(section_text)[1:-1] + _PAYLOAD_TAIL  # Strip the surrounding quotes from the encoded string
+
+# Expected shape of the model's analysis for one chunk, validated in a single pass by pydantic-core while parsing the JSON.
+# Only what the aggregation relies on is checked (a string summary and list containers); item contents and extra fields
+# pass through to the frontend unchanged.
+class ChunkAnalysis(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    summary: str
+    abnormal_results: list[dict] = []
+    charts: list[dict] = []
+    recommendations: list = []
+
+# Fields the aggregation joins or extends, with the types it needs
+AGGREGATED_LIST_FIELDS = ("abnormal_results", "charts", "recommendations")
+
+# Repair prompts carry only the invalid output and the errors; both are capped so the request fits the model's small context
+REPAIR_MAX_CONTENT_CHARS = 2400
+REPAIR_MAX_ERRORS = 5
+REPAIR_SYSTEM_PROMPT = "You fix malformed JSON. Return only the corrected JSON object, with no other text."
+
+# Minimum interval between streaming progress broadcasts for a chunk, so users see progress without a message per token
+STREAM_PROGRESS_INTERVAL = 0.5
 
-# WebSocket connection management: Efficiently manage multiple concurrent WebSocket connections using a set, ensuring low-latency real-time communication
-active_connections = set()
+# Model response cache: an in-process TTL cache (L1) in front of an optional shared Redis cache (L2), so repeated report
+# sections such as standard headers and reference-range tables are only sent to the model once
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "86400"))  # Cached responses expire after one day by default
+llm_response_cache = TTLCache(maxsize=2048, ttl=LLM_CACHE_TTL)
+
+# Whole-report cache keyed by the SHA-256 of the uploaded file, so re-uploads of the same report (retries, multiple tabs)
+# skip extraction and analysis entirely
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", "604800"))  # Cached reports expire after one week by default
+pdf_result_cache = TTLCache(maxsize=256, ttl=PDF_CACHE_TTL)
+
+# Key whole-report results by the file digest and a fingerprint of the analysis configuration, so changing the model,
+# prompt, or chunking invalidates reports cached before the change, including in Redis across deploys
+def _pdf_cache_key(pdf_digest: str, token_encoder) -> str:
+    analysis_fingerprint = hashlib.sha256(
+        f"{MODEL_NAME}\0{ANALYSIS_SYSTEM_MESSAGE}\0{_token_counting_mode(token_encoder)}\0{CHUNK_MAX_TOKENS}".encode()
+    ).hexdigest()
+    return f"pdf:{analysis_fingerprint[:16]}:{pdf_digest}"
+
+# Derive a deterministic cache key from everything that determines the model's answer for a chunk
+def _llm_cache_key(chunk: str) -> str:
+    return "llm:" + hashlib.sha256((MODEL_NAME + ANALYSIS_SYSTEM_MESSAGE + chunk).encode()).hexdigest()
+
+# Look up a cached result, checking the in-process cache before Redis and promoting Redis hits into the in-process cache
+async def _get_cached(cache_client, local_cache: TTLCache, cache_key: str):
+    if cache_key in local_cache:
+        return local_cache[cache_key]
+    if cache_client is None:
+        return None
+    try:
+        cached_value = await cache_client.get(cache_key)
+    except Exception as error:
+        # A cache outage must never fail the analysis; fall through to recomputing the result instead
+        logger.warning(f"Cache lookup failed for {cache_key}: {str(error)}")
+        return None
+    if cached_value is None:
+        return None
+    cached_result = orjson.loads(cached_value)
+    local_cache[cache_key] = cached_result
+    return cached_result
+
+# Store a result in both cache levels
+async def _set_cached(cache_client, local_cache: TTLCache, cache_key: str, result: dict, ttl: int):
+    local_cache[cache_key] = result
+    if cache_client is None:
+        return
+    try:
+        await cache_client.setex(cache_key, ttl, orjson.dumps(result))
+    except Exception as error:
+        logger.warning(f"Cache store failed for {cache_key}: {str(error)}")
+
+# Chunking configuration: report text is packed into chunks by token count rather than fixed character slices, so each
+# model call carries a predictable amount of input and dense tables are not split into needlessly many requests
+# The tiktoken encoder is loaded at startup on a worker thread: tiktoken downloads its BPE file on first run unless it is already in
+# TIKTOKEN_CACHE_DIR, so hosts without egress pre-seed that directory. If loading fails, token counts fall back to a
+# character-based estimate instead of preventing the service from starting, and the load is retried periodically.
+TOKEN_ENCODING_NAME = "cl100k_base"
+# cl100k splits digit runs into groups of at most three and gives units and punctuation their own tokens, so numeric lab
+# tables run at about 2 characters per token (prose is closer to 4); estimating with the dense case keeps chunks in budget
+CHARS_PER_TOKEN_ESTIMATE = 2
+TOKEN_ENCODER_RETRY_INTERVAL = 60  # Seconds to wait after a failed load before trying again
+_token_encoder = None
+_token_encoder_retry_at = 0.0  # Monotonic time after which a failed load may be retried
+_token_encoder_lock = threading.Lock()  # Uploads call the loader from worker threads; only one should download at a time
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "1000"))  # Leaves room for the prompt scaffold and the response in the model context
+
+# Uploads are copied to disk in 1 MiB blocks to keep peak memory flat regardless of report size
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Backpressure: cap how many uploads are processed at once and how many model requests are in flight across all uploads,
+# so bursts of uploads queue up instead of exhausting memory, file descriptors, and the model API rate limit
+UPLOAD_SEMAPHORE = asyncio.Semaphore(int(os.getenv("MAX_UPLOADS", "8")))
+MODEL_REQUEST_SEMAPHORE = asyncio.Semaphore(int(os.getenv("MAX_MODEL_REQUESTS", "16")))
+
+# WebSocket connection management: active connections keyed by connection id, so disconnects are a cheap pop, broadcasts iterate
+# in connection order, and per-connection state can later be attached under the same key
+active_connections: dict[int, WebSocket] = {}
 
 @app.websocket("/ws")
 async def websocket_handler(websocket: WebSocket):
     await websocket.accept()  # Accept incoming WebSocket connection for real-time communication
-    active_connections.add(websocket)  # Track active connections for broadcasting messages
+    connection_id = id(websocket)
+    active_connections[connection_id] = websocket  # Track active connections for broadcasting messages
     try:
         # Infinite loop to keep the WebSocket connection open; in production, consider timeout mechanisms or heartbeat checks
         while True:
             await websocket.receive_text()  # Wait for messages from the client; can be extended for interactive features
     finally:
-        # Ensure connection is removed from the active set upon disconnection or error, preventing memory leaks
-        active_connections.remove(websocket)
+        # Ensure connection is removed from the active connections upon disconnection or error, preventing memory leaks
+        active_connections.pop(connection_id, None)
 
 # Broadcast status updates to all active WebSocket clients, ensuring all clients receive consistent updates
 async def broadcast_status_update(status_message: str):
-    for connection in active_connections:
-        await connection.send_json({"status": status_message})  # Structured JSON messages for consistent frontend parsing
+    status_payload = orjson.dumps({"status": status_message}).decode()  # Serialize once and send the same text frame to every client
+    # Send to a snapshot of the connections concurrently, so disconnects during the fan-out cannot mutate what is being iterated
+    # and a failing client does not block the others
+    connection_snapshot = list(active_connections.items())
+    send_results = await asyncio.gather(
+        *(connection.send_text(status_payload) for _, connection in connection_snapshot),  # Structured JSON messages for consistent frontend parsing
+        return_exceptions=True,
+    )
+    for (connection_id, _), send_result in zip(connection_snapshot, send_results):
+        if isinstance(send_result, BaseException):
+            # Drop dead sockets so later broadcasts do not keep attempting sends to them
+            logger.warning(f"Dropping WebSocket connection {connection_id} after failed send: {str(send_result)}")
+            active_connections.pop(connection_id, None)
 
 # Endpoint for handling file uploads and processing: Asynchronous to handle high concurrency, enabling scalability
 @app.post("/upload")
-async def handle_pdf_upload(uploaded_file: UploadFile = File(...)):
+async def handle_pdf_upload(request: Request, uploaded_file: UploadFile = File(...)):
     await broadcast_status_update("File received. Initiating analysis...")  # Immediate feedback to the user for improved UX
     logger.info(f"File received: {uploaded_file.filename}")  # Log the filename for auditing and debugging purposes
+    pdf_path = None  # Location of the spooled upload on disk, removed once processing finishes
     try:
         # Validate the file type to prevent unsupported file formats from entering the processing pipeline
         if not uploaded_file.filename.endswith(".pdf"):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
-        file_bytes = await uploaded_file.read()  # Efficiently read the file content into memory for processing
-        await broadcast_status_update(f"File size: {len(file_bytes)} bytes. Extracting content...")  # Notify user of ongoing processing
-        logger.info(f"File size: {len(file_bytes)} bytes")  # Log file size for monitoring and optimization purposes
+        file_size, pdf_digest = await asyncio.to_thread(_hash_upload_sync, uploaded_file.file)  # Hash the upload off the event loop
+        logger.info(f"File size: {file_size} bytes")  # Log file size for monitoring and optimization purposes
+
+        # Serve re-uploads of an already analyzed report straight from the cache, without waiting for a processing slot
+        token_encoder = _token_encoder or await asyncio.to_thread(_get_token_encoder)  # Retries a failed load off the event loop; used for both key and chunking
+        pdf_cache_key = _pdf_cache_key(pdf_digest, token_encoder)
+        cached_results = await _get_cached(request.app.state.cache, pdf_result_cache, pdf_cache_key)
+        if cached_results is not None:
+            await broadcast_status_update("Analysis served from cache.")  # Notify the user that the stored analysis was reused
+            logger.info(f"Served analysis for {pdf_digest} from cache")
+            return cached_results
+
+        if UPLOAD_SEMAPHORE.locked():
+            await broadcast_status_update("Server busy. Waiting for an available processing slot...")  # Explain the queueing delay to the user
+        async with UPLOAD_SEMAPHORE:
+            pdf_path = await asyncio.to_thread(_spool_upload_sync, uploaded_file.file)  # Stream the upload to disk off the event loop
+            await broadcast_status_update(f"File size: {file_size} bytes. Extracting content...")  # Notify user of ongoing processing
 
-        extracted_text = await extract_text_from_pdf(file_bytes)  # Extract text from PDF asynchronously to avoid blocking
-        await broadcast_status_update(f"Extracted {len(extracted_text)} characters from PDF. Analyzing content...")  # Progress update
-        logger.info(f"Extracted text length: {len(extracted_text)} characters")  # Detailed logging for traceability
+            extracted_text = await extract_text_from_pdf(pdf_path, request.app.state)  # Extract text from PDF asynchronously to avoid blocking
+            await broadcast_status_update(f"Extracted {len(extracted_text)} characters from PDF. Analyzing content...")  # Progress update
+            logger.info(f"Extracted text length: {len(extracted_text)} characters")  # Detailed logging for traceability
 
-        analysis_results = await analyze_pdf_content(extracted_text)  # Asynchronously analyze the extracted text using the AI model
-        await broadcast_status_update("Analysis successfully completed.")  # Notify the user upon successful analysis completion
-        logger.info("Analysis successfully completed")  # Final log entry for the process
-        return analysis_results  # Return the analysis results as a structured JSON response
+            analysis_results, analysis_complete = await analyze_pdf_content(extracted_text, request.app.state.http, request.app.state.cache, token_encoder)  # Asynchronously analyze the extracted text using the AI model
+            if analysis_complete:
+                # Only cache reports whose chunks all succeeded, so a transient failure is not replayed on every re-upload
+                await _set_cached(request.app.state.cache, pdf_result_cache, pdf_cache_key, analysis_results, PDF_CACHE_TTL)
+            await broadcast_status_update("Analysis successfully completed.")  # Notify the user upon successful analysis completion
+            logger.info("Analysis successfully completed")  # Final log entry for the process
+            return analysis_results  # Return the analysis results as a structured JSON response
     except Exception as error:
         # Comprehensive error handling with detailed logging for diagnostics and user-friendly error messages
         error_log_message = f"Error processing file: {str(error)}"
@@ -82,121 +312,342 @@ async def handle_pdf_upload(uploaded_file: UploadFile = File(...)):
         logger.error(error_log_message)  # Log the error for further analysis
         logger.error(traceback.format_exc())  # Capture full stack trace for debugging
         raise HTTPException(status_code=500, detail=error_log_message)  # Raise an HTTP 500 error to signal a server-side issue
+    finally:
+        if pdf_path is not None:
+            os.remove(pdf_path)  # Clean up the temporary file regardless of outcome
+
+# Hash an uploaded file in fixed-size blocks to identify repeat uploads of the same report, then rewind it for spooling
+def _hash_upload_sync(source_file) -> tuple:
+    file_hash = hashlib.sha256()
+    file_size = 0
+    while file_block := source_file.read(UPLOAD_BLOCK_SIZE):
+        file_hash.update(file_block)
+        file_size += len(file_block)
+    source_file.seek(0)
+    return file_size, file_hash.hexdigest()
+
+# Copy an uploaded file to a temporary file on disk in fixed-size blocks, so the whole PDF is never held in the Python heap
+def _spool_upload_sync(source_file) -> str:
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as spooled_file:
+        try:
+            shutil.copyfileobj(source_file, spooled_file, UPLOAD_BLOCK_SIZE)
+        except BaseException:
+            # The caller never learns the path if the copy fails (e.g. disk full), so remove the partial file here
+            spooled_file.close()
+            os.remove(spooled_file.name)
+            raise
+        return spooled_file.name
+
+# Synchronous PDF text extraction using PyMuPDF, whose native MuPDF parser is far faster than pure-Python alternatives
+def _extract_sync(pdf_path: str) -> tuple:
+    with fitz.open(pdf_path) as pdf_document:  # Open the PDF from disk so MuPDF reads it directly instead of copying bytes between processes
+        extracted_text = "\n".join(page.get_text("text") for page in pdf_document)  # Concatenate the text of every page in order
+        return extracted_text, pdf_document.page_count
 
-# Asynchronous function to extract text content from a PDF file using PyPDF2, which handles PDFs in-memory for efficiency
-async def extract_text_from_pdf(pdf_bytes: bytes) -> str:
+# Asynchronous wrapper that runs extraction in a worker process so the event loop stays free for WebSocket traffic
+async def extract_text_from_pdf(pdf_path: str, app_state) -> str:
+    pdf_pool = app_state.pdf_pool
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))  # Create an in-memory PDF reader instance
-        extracted_text = ""  # Initialize an empty string to store extracted text
-        for page_index, page in enumerate(pdf_reader.pages):
-            # Extract text from each page and append it to the result, ensuring pages are processed sequentially
-            extracted_text += page.extract_text() + "\n"
-            await broadcast_status_update(f"Extracted page {page_index+1} of {len(pdf_reader.pages)}")  # Real-time updates for each page
-        logger.info(f"Extracted {len(pdf_reader.pages)} pages from PDF")  # Log the number of pages processed
+        event_loop = asyncio.get_running_loop()
+        extracted_text, page_count = await event_loop.run_in_executor(pdf_pool, _extract_sync, pdf_path)  # Parse off the event loop
+        await broadcast_status_update(f"Extracted {page_count} pages from PDF")  # Single progress update once all pages are parsed
+        logger.info(f"Extracted {page_count} pages from PDF")  # Log the number of pages processed
         return extracted_text  # Return the concatenated text from all pages
+    except BrokenProcessPool:
+        # A worker died (e.g. MuPDF crashing on a malformed PDF or an OOM kill), which permanently breaks the pool; replace it
+        # so later uploads keep working. The identity check ensures concurrent failures replace the pool only once.
+        logger.error("PDF extraction pool is broken; recreating it")
+        logger.error(traceback.format_exc())
+        if app_state.pdf_pool is pdf_pool:
+            app_state.pdf_pool = _create_pdf_pool()
+            pdf_pool.shutdown(wait=False)
+        raise
     except Exception as error:
         # Log any extraction errors with full tracebacks to identify issues in PDF processing
         logger.error(f"Error extracting PDF content: {str(error)}")
         logger.error(traceback.format_exc())
         raise  # Re-raise the exception to ensure it is propagated up the call stack
 
-# Asynchronous function to analyze the extracted PDF content using the Falcon 180B model via API
-async def analyze_pdf_content(pdf_content: str) -> dict:
+# Analyze a single chunk of the report with the Falcon 180B model; returns (index, parsed result) so callers can restore ordering
+async def _analyze_chunk(http_session: aiohttp.ClientSession, cache_client, chunk_index: int, chunk: str, total_chunks: int) -> tuple:
+    await broadcast_status_update(f"Processing chunk {chunk_index+1} of {total_chunks}...")  # Notify user of progress
+    logger.info(f"Processing chunk {chunk_index+1} of {total_chunks}")  # Log each chunk being processed
+
+    # Serve previously analyzed sections from the cache, skipping the model call entirely
+    cache_key = _llm_cache_key(chunk)
+    cached_chunk = await _get_cached(cache_client, llm_response_cache, cache_key)
+    if cached_chunk is not None:
+        await broadcast_status_update(f"Served chunk {chunk_index+1} from cache")  # Notify user of the cache hit
+        return chunk_index, cached_chunk
+
+    # Only the section number and chunk text are encoded per request; the shared scaffold was serialized once at import time
+    request_body = _build_request_body(f"{chunk_index+1}/{total_chunks}:\n{chunk}")
+
+    async with MODEL_REQUEST_SEMAPHORE:  # Hold a slot only for the duration of the model call itself
+        await broadcast_status_update(f"Sending request to AI model for chunk {chunk_index+1}")  # Notify user before sending the request
+        async with http_session.post(MODEL_API_URL, headers=MODEL_REQUEST_HEADERS, data=request_body) as api_response:
+            api_response.raise_for_status()  # Immediately handle HTTP errors, ensuring only successful responses are processed
+            completion_text = await _read_streamed_completion(api_response, chunk_index)  # Consume tokens as they are generated
+            await broadcast_status_update(f"Received response from AI model for chunk {chunk_index+1}")  # Notify user of successful receipt
+
+    # Parse and validate the assembled AI model response in one pass, ensuring data integrity and consistency
+    try:
+        chunk_analysis = ChunkAnalysis.model_validate_json(completion_text)
+    except ValidationError as validation_error:
+        # Ask the model to correct only the reported problems instead of reprocessing the whole section
+        await broadcast_status_update(f"Repairing AI model response for chunk {chunk_index+1}")  # Notify user of the extra round-trip
+        logger.warning(f"Invalid AI model response for chunk {chunk_index+1}: {str(validation_error)}")
+        try:
+            chunk_analysis = await _repair_chunk_analysis(http_session, completion_text, validation_error)
+        except Exception as repair_error:
+            # Keep whatever the original response got right rather than dropping the chunk; salvaged results are not cached
+            salvaged_chunk = _salvage_chunk_analysis(completion_text)
+            if salvaged_chunk is None:
+                raise
+            logger.warning(f"Repair failed for chunk {chunk_index+1}, using the unvalidated response: {str(repair_error)}")
+            await broadcast_status_update(f"Using unvalidated AI model response for chunk {chunk_index+1}")
+            return chunk_index, salvaged_chunk
+    parsed_chunk = chunk_analysis.model_dump(exclude_unset=True)  # Omit fields the model did not send, as the raw JSON did
+    await _set_cached(cache_client, llm_response_cache, cache_key, parsed_chunk, LLM_CACHE_TTL)  # Only validated responses are cached
+    await broadcast_status_update(f"Successfully parsed AI model response for chunk {chunk_index+1}")  # Notify user of successful parsing
+    return chunk_index, parsed_chunk
+
+# Fall back to the raw parsed response when it is a JSON object, dropping only values the aggregation cannot combine
+def _salvage_chunk_analysis(completion_text: str):
+    try:
+        raw_chunk = orjson.loads(completion_text)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(raw_chunk, dict):
+        return None
+    if not isinstance(raw_chunk.get("summary", ""), str):
+        raw_chunk.pop("summary")
+    for field_name in AGGREGATED_LIST_FIELDS:
+        if not isinstance(raw_chunk.get(field_name, []), list):
+            raw_chunk.pop(field_name)
+    return raw_chunk
+
+# Re-prompt the model with a minimal request: a short instruction, its invalid output, and the specific validation errors.
+# The schema and section text are not resent, so the repair fits in the context the original request may have exhausted.
+async def _repair_chunk_analysis(http_session: aiohttp.ClientSession, invalid_content: str, validation_error: ValidationError) -> ChunkAnalysis:
+    error_details = "; ".join(
+        f"{'.'.join(str(part) for part in error['loc']) or 'response'}: {error['msg']}"
+        for error in validation_error.errors()[:REPAIR_MAX_ERRORS]
+    )
+    repair_payload = {
+        "model": MODEL_NAME,
+        "messages": [
+            {"role": "system", "content": REPAIR_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Errors: {error_details}\n\nJSON:\n{invalid_content[:REPAIR_MAX_CONTENT_CHARS]}"},
+        ],
+    }
+    async with MODEL_REQUEST_SEMAPHORE:
+        async with http_session.post(MODEL_API_URL, headers=MODEL_REQUEST_HEADERS, data=orjson.dumps(repair_payload)) as api_response:
+            api_response.raise_for_status()
+            result_json = orjson.loads(await api_response.read())
+    return ChunkAnalysis.model_validate_json(_completion_content(result_json))  # A second failure propagates as a chunk error
+
+# Extract the message content from a non-streamed chat completion, surfacing API error bodies instead of a missing key
+def _completion_content(result_json: dict) -> str:
+    if result_json.get("error"):
+        raise RuntimeError(f"AI model returned an error: {result_json['error']}")
+    return result_json["choices"][0]["message"]["content"]
+
+# Assemble a streamed chat completion from its server-sent events, broadcasting throttled progress as tokens arrive
+async def _read_streamed_completion(api_response: aiohttp.ClientResponse, chunk_index: int) -> str:
+    if api_response.content_type != "text/event-stream":
+        # The endpoint ignored "stream" or answered with an error body; parse it as a regular completion
+        return _completion_content(orjson.loads(await api_response.read()))
+    content_parts = []
+    received_chars = 0
+    last_progress_update = time.monotonic()
+    async for raw_line in api_response.content:
+        line = raw_line.strip()
+        if not line.startswith(b"data:"):
+            continue  # Skip blank separator lines, keep-alives, and SSE comments
+        event_data = line[len(b"data:"):].strip()
+        if event_data == b"[DONE]":
+            break  # End-of-stream marker
+        stream_event = orjson.loads(event_data)
+        if stream_event.get("error"):
+            raise RuntimeError(f"AI model stream returned an error: {stream_event['error']}")  # Fail the chunk rather than return partial text
+        choices = stream_event.get("choices") or []
+        if not choices:
+            continue
+        content_delta = (choices[0].get("delta") or {}).get("content") or ""
+        content_parts.append(content_delta)
+        received_chars += len(content_delta)
+        now = time.monotonic()
+        if now - last_progress_update >= STREAM_PROGRESS_INTERVAL:
+            last_progress_update = now
+            await broadcast_status_update(f"Chunk {chunk_index+1} streaming: {received_chars} characters received")  # Real latency feedback
+    return "".join(content_parts)
+
+# Return the shared tiktoken encoder, loading it if needed; None means the character-based estimate is in use. A failed
+# load is retried once TOKEN_ENCODER_RETRY_INTERVAL has passed, so a transient outage does not last for the process lifetime.
+# May block on a download, so call it from a worker thread.
+def _get_token_encoder():
+    global _token_encoder, _token_encoder_retry_at
+    if _token_encoder is None and time.monotonic() >= _token_encoder_retry_at:
+        with _token_encoder_lock:
+            if _token_encoder is None and time.monotonic() >= _token_encoder_retry_at:
+                try:
+                    _token_encoder = tiktoken.get_encoding(TOKEN_ENCODING_NAME)  # Constructing an encoder is expensive; reuse it
+                except Exception as error:
+                    _token_encoder_retry_at = time.monotonic() + TOKEN_ENCODER_RETRY_INTERVAL
+                    logger.warning(f"Could not load tiktoken encoding {TOKEN_ENCODING_NAME}, estimating tokens from characters: {str(error)}")
+    return _token_encoder
+
+# Describe how tokens are being counted, so results chunked by estimate are cached separately from tokenizer-chunked ones
+def _token_counting_mode(token_encoder) -> str:
+    return TOKEN_ENCODING_NAME if token_encoder is not None else f"chars/{CHARS_PER_TOKEN_ESTIMATE}"
+
+# Count the tokens in a piece of text, estimating from its length when the encoder is unavailable
+def _count_tokens(text: str, token_encoder) -> int:
+    if token_encoder is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN_ESTIMATE)
+    return len(token_encoder.encode(text))
+
+# Cut text that exceeds the budget into (piece, token_count) windows at token boundaries, or character boundaries as a fallback
+def _split_by_tokens(text: str, max_tokens: int, token_encoder):
+    if token_encoder is None:
+        window_chars = max_tokens * CHARS_PER_TOKEN_ESTIMATE
+        for start in range(0, len(text), window_chars):
+            text_window = text[start:start+window_chars]
+            yield text_window, _count_tokens(text_window, token_encoder)
+        return
+    # Cut only where a token starts a new character, rather than decoding raw token windows: a window edge that falls inside a
+    # multi-byte character (µ, °, ≥) would otherwise turn it into replacement characters on both sides of the cut
+    tokens = token_encoder.encode(text)
+    token_bytes = token_encoder.decode_tokens_bytes(tokens)
+    decoded_text, token_offsets = token_encoder.decode_with_offsets(tokens)
+    window_start = 0
+    while window_start < len(tokens):
+        window_end = min(window_start + max_tokens, len(tokens))
+        while window_end < len(tokens) and window_end > window_start + 1 and 0x80 <= token_bytes[window_end][0] < 0xC0:
+            window_end -= 1  # Step back until the next window begins on a character boundary
+        while window_end < len(tokens) and 0x80 <= token_bytes[window_end][0] < 0xC0:
+            window_end += 1  # A single character wider than the budget is kept whole rather than split
+        text_end = token_offsets[window_end] if window_end < len(tokens) else len(decoded_text)
+        text_window = decoded_text[token_offsets[window_start]:text_end]
+        yield text_window, _count_tokens(text_window, token_encoder)
+        window_start = window_end
+
+# Yield (segment, token_count, separator) triples no larger than max_tokens, preferring paragraph, then line, then raw token
+# boundaries; the separator is the text that originally preceded the segment, so packing preserves the report's layout
+def _iter_segments(text: str, max_tokens: int, token_encoder):
+    for paragraph in text.split("\n\n"):
+        if not paragraph.strip():
+            continue  # Skip blank paragraphs so they do not produce empty chunks
+        paragraph_tokens = _count_tokens(paragraph, token_encoder)
+        if paragraph_tokens <= max_tokens:
+            yield paragraph, paragraph_tokens, "\n\n"
+            continue
+        for line_index, line in enumerate(paragraph.split("\n")):
+            line_separator = "\n\n" if line_index == 0 else "\n"
+            line_tokens = _count_tokens(line, token_encoder)
+            if line_tokens <= max_tokens:
+                yield line, line_tokens, line_separator
+                continue
+            # A single line longer than the budget is cut at token boundaries as a last resort
+            for window_index, (line_window, window_tokens) in enumerate(_split_by_tokens(line, max_tokens, token_encoder)):
+                yield line_window, window_tokens, line_separator if window_index == 0 else ""
+
+# Greedily pack text segments into chunks of at most max_tokens tokens, keeping paragraphs intact wherever possible and
+# counting the separators between segments against the budget. The encoder is passed in rather than looked up so one call
+# never mixes counting modes; None selects the character-based estimate.
+def pack_chunks(text: str, token_encoder, max_tokens: int = CHUNK_MAX_TOKENS) -> list:
+    packed_chunks = []
+    separator_tokens = {}  # Token cost of each distinct separator, computed once per call
+    buffer, buffer_tokens = [], 0
+    for segment, segment_tokens, separator in _iter_segments(text, max_tokens, token_encoder):
+        if buffer:
+            if separator not in separator_tokens:
+                separator_tokens[separator] = _count_tokens(separator, token_encoder)
+            joined_tokens = buffer_tokens + separator_tokens[separator] + segment_tokens
+            if joined_tokens <= max_tokens:
+                buffer.extend((separator, segment))
+                buffer_tokens = joined_tokens
+                continue
+            packed_chunks.append("".join(buffer))  # Current chunk is full; start a new one with this segment
+        buffer, buffer_tokens = [segment], segment_tokens
+    if buffer:
+        packed_chunks.append("".join(buffer))
+    return packed_chunks
+
+# Asynchronous function to analyze the extracted PDF content using the Falcon 180B model via API; returns the aggregated
+# results together with whether every chunk was analyzed successfully
+async def analyze_pdf_content(pdf_content: str, http_session: aiohttp.ClientSession, cache_client=None, token_encoder=None) -> tuple:
     logger.info("Commencing analysis of medical report")  # Log the start of the analysis process
     await broadcast_status_update("Analyzing medical report...")  # Notify user that analysis is in progress
 
-    # Chunking the content to comply with API input size limits, a common strategy to handle large inputs in NLP tasks
-    content_chunks = [pdf_content[i:i+1500] for i in range(0, len(pdf_content), 1500)]
-    all_analysis_results = []  # Initialize a list to store results from each chunk
-
-    async with aiohttp.ClientSession() as http_session:  # Use aiohttp for efficient asynchronous HTTP requests
-        for chunk_index, chunk in enumerate(content_chunks):
-            await broadcast_status_update(f"Processing chunk {chunk_index+1} of {len(content_chunks)}...")  # Notify user of progress
-            logger.info(f"Processing chunk {chunk_index+1} of {len(content_chunks)}")  # Log each chunk being processed
-
-            # Dynamic prompt generation for the AI model, ensuring the prompt is contextually relevant for each chunk
-            analysis_prompt = f"""
-            Analyze the following section of a medical report and extract key information.
-            Return the results in a JSON format with the following structure:
-            {{
-                "summary": "Brief summary of this report section",
-                "abnormal_results": [
-                    {{"test_name": "Test Name", "value": "Abnormal Value", "reference_range": "Normal Range", "interpretation": "Brief interpretation"}}
-                ],
-                "charts": [
-                    {{
-                        "chart_type": "bar",
-                        "title": "Chart Title",
-                        "data": [
-                            {{"label": "Category1", "value1": Number1, "value2": Number2, ...}},
-                            {{"label": "Category2", "value1": Number1, "value2": Number2, ...}},
-                            ...
-                        ]
-                    }},
-                    {{
-                        "chart_type": "area",
-                        "title": "Chart Title",
-                        "x_axis_key": "month",
-                        "data_keys": ["value1", "value2", ...],
-                        "data": [
-                            {{"month": "January", "value1": Number1, "value2": Number2, ...}},
-                            {{"month": "February", "value1": Number1, "value2": Number2, ...}},
-                            ...
-                        ],
-                        "trend_percentage": 5.2,
-                        "date_range": "January - June 2024"
-                    }}
-                ],
-                "recommendations": ["Recommendation 1", "Recommendation 2", ...]
-            }}
+    # Chunking the content to comply with API input size limits, packing whole paragraphs up to the token budget
+    content_chunks = await asyncio.to_thread(pack_chunks, pdf_content, token_encoder)  # Tokenizing every paragraph is CPU work; keep it off the event loop
 
-            Medical Report Section {chunk_index+1}/{len(content_chunks)}:
-            {chunk}
-            """
+    # Group identical chunks (repeated disclaimers, reference-range tables) so each distinct section is sent to the model once
+    chunk_positions = {}
+    for chunk_index, chunk in enumerate(content_chunks):
+        chunk_positions.setdefault(chunk, []).append(chunk_index)
+    duplicate_count = len(content_chunks) - len(chunk_positions)
+    if duplicate_count:
+        await broadcast_status_update(f"Skipping {duplicate_count} duplicate chunks")  # Let the user know fewer requests are needed
+        logger.info(f"Deduplicated {duplicate_count} of {len(content_chunks)} chunks")
 
-            # Prepare HTTP request with secure authorization headers, ensuring API keys are not exposed
-            request_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {MODEL_API_KEY}",
-            }
-            request_payload = {
-                "model": "tiiuae/falcon-180B-chat",  # Specify the model used for processing
-                "messages": [
-                    {"role": "system", "content": "You are a medical expert analyzing health reports."},  # Context-setting for the model
-                    {"role": "user", "content": analysis_prompt},
-                ],
-            }
+    # Dispatch all distinct chunks concurrently over the shared session; total latency becomes that of the slowest chunk rather than the sum
+    chunk_outcomes = await asyncio.gather(
+        *[_analyze_chunk(http_session, cache_client, positions[0], chunk, len(content_chunks)) for chunk, positions in chunk_positions.items()],
+        return_exceptions=True,
+    )
+
+    # Expand each distinct result back into every position it occurred at, preserving the original order of the report
+    chunk_errors = []
+    positioned_results = [None] * len(content_chunks)
+    for positions, outcome in zip(chunk_positions.values(), chunk_outcomes):
+        if isinstance(outcome, BaseException):
+            chunk_errors.append((positions[0], outcome))
+            continue
+        for chunk_index in positions:
+            positioned_results[chunk_index] = outcome[1]
+
+    for chunk_index, error in chunk_errors:
+        # Handle and log errors on a per-chunk basis so a single failure does not discard the other chunks
+        chunk_error_message = f"Error processing chunk {chunk_index+1}: {str(error)}"
+        await broadcast_status_update(chunk_error_message)  # Notify user of the error
+        logger.error(chunk_error_message)  # Log the error for later analysis
+        logger.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))  # Include the full stack trace for diagnostics
 
-            try:
-                await broadcast_status_update(f"Sending request to AI model for chunk {chunk_index+1}")  # Notify user before sending the request
-                async with http_session.post(MODEL_API_URL, headers=request_headers, json=request_payload) as api_response:
-                    api_response.raise_for_status()  # Immediately handle HTTP errors, ensuring only successful responses are processed
-                    result_json = await api_response.json()  # Parse the JSON response from the API
-                    await broadcast_status_update(f"Received response from AI model for chunk {chunk_index+1}")  # Notify user of successful receipt
-
-                # Parse and store the AI model's response for this chunk, ensuring data integrity and consistency
-                parsed_chunk = json.loads(result_json["choices"][0]["message"]["content"])
-                all_analysis_results.append(parsed_chunk)  # Append the parsed results to the overall list
-                await broadcast_status_update(f"Successfully parsed AI model response for chunk {chunk_index+1}")  # Notify user of successful parsing
-            except Exception as error:
-                # Handle and log errors on a per-chunk basis to ensure other chunks can still be processed
-                chunk_error_message = f"Error processing chunk {chunk_index+1}: {str(error)}"
-                await broadcast_status_update(chunk_error_message)  # Notify user of the error
-                logger.error(chunk_error_message)  # Log the error for later analysis
-                logger.error(traceback.format_exc())  # Include the full stack trace for diagnostics
-
-    # Aggregate results from all processed chunks into a cohesive final output
+    # Aggregate results from all processed chunks into a cohesive final output in a single pass, skipping failed chunks
+    summaries, abnormal_results, charts, recommendations = [], [], [], []
+    for result in positioned_results:
+        if result is None:
+            continue
+        summaries.append(result.get("summary", ""))  # Combine summaries from all chunks
+        abnormal_results.extend(result.get("abnormal_results", ()))  # Aggregate abnormal results
+        charts.extend(result.get("charts", ()))  # Combine chart data for visualization
+        recommendations.extend(result.get("recommendations", ()))  # Aggregate recommendations
     aggregated_results = {
-        "summary": " ".join([result["summary"] for result in all_analysis_results]),  # Combine summaries from all chunks
-        "abnormal_results": [item for result in all_analysis_results for item in result.get("abnormal_results", [])],  # Aggregate abnormal results
-        "charts": [item for result in all_analysis_results for item in result.get("charts", [])],  # Combine chart data for visualization
-        "recommendations": [item for result in all_analysis_results for item in result.get("recommendations", [])]  # Aggregate recommendations
+        "summary": " ".join(summaries),
+        "abnormal_results": abnormal_results,
+        "charts": charts,
+        "recommendations": recommendations,
     }
 
     await broadcast_status_update("Finalizing analysis results...")  # Notify user that final results are being prepared
-    return aggregated_results  # Return the final, aggregated analysis results to the client
+    return aggregated_results, not chunk_errors  # Return the final, aggregated analysis results to the client
 
 # Run the FastAPI application using Uvicorn, a high-performance ASGI server, ensuring it is production-ready with appropriate security configurations
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)  # Run the server on all available interfaces (0.0.0.0) to allow external access
+    # uvloop and httptools replace the stdlib event loop and HTTP parser with their C implementations for faster socket handling.
+    # A single worker is kept because WebSocket clients and upload progress broadcasts must live in the same process.
+    # TLS is terminated by the reverse proxy in front of this process (see nginx.conf), so Uvicorn serves plain HTTP and trusts
+    # the proxy's forwarded headers for the original client address and scheme.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",  # Run the server on all available interfaces (0.0.0.0) so the proxy can reach it
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),  # Set to the proxy's address when it runs on another host
+    )